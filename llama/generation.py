@@ -4,8 +4,11 @@
 
 import json
 import os
+import re
 import sys
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Literal, Optional, Tuple, TypedDict
 
@@ -13,6 +16,7 @@ import torch
 import torch.nn.functional as F
 from fairscale.nn.model_parallel.initialize import (
     get_model_parallel_rank,
+    get_model_parallel_world_size,
     initialize_model_parallel,
     model_parallel_is_initialized,
 )
@@ -84,9 +88,79 @@ B_INST, E_INST = "[INST]", "[/INST]"
 B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
 SPECIAL_TAGS = [B_INST, E_INST, "<<SYS>>", "<</SYS>>"]
 
+# Compiled alternation matching any special tag. One regex search walks a message once for
+# all tags, instead of one full `in` scan of the content per tag.
+_TAG_RE = re.compile("|".join(re.escape(tag) for tag in SPECIAL_TAGS))
+
 # Define the error message when special tags are included in the prompt.
 UNSAFE_ERROR = "Error: special tags are not allowed as part of the prompt."
 
+# Thread pool used for prompt tokenization, created lazily on first use so that importing the
+# module does not spawn threads.
+_TOK_POOL: Optional[ThreadPoolExecutor] = None
+
+
+def _tokenizer_pool() -> ThreadPoolExecutor:
+    """Return the shared thread pool used for parallel tokenization.
+
+    Returns:
+        ThreadPoolExecutor: The lazily created, process-wide tokenizer pool.
+
+    Note:
+        SentencePiece releases the GIL inside its C++ encoder, so mapping `encode` calls over
+        a thread pool gives real parallelism (roughly min(len(prompts), n_cores)x) instead of
+        a serial Python loop around the C++ call.
+    """
+    global _TOK_POOL
+    if _TOK_POOL is None:
+        _TOK_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+    return _TOK_POOL
+
+
+def _decode_token_pieces(
+    tokenizer: Tokenizer, token_lists: List[List[int]]
+) -> List[List[str]]:
+    """Decode each token of each sequence into its surface string.
+
+    Args:
+        tokenizer (Tokenizer): The tokenizer used for decoding.
+        token_lists (List[List[int]]): Token ID sequences to decode token by token.
+
+    Returns:
+        List[List[str]]: Per-sequence lists of decoded token strings.
+
+    Note:
+        All sequences are flattened into one `Tokenizer.pieces` batch call and the result is
+        reshaped back, so the whole batch costs a single Python<->C++ transition instead of
+        one per token.
+    """
+    flat_ids = [x for t in token_lists for x in t]
+    pieces = tokenizer.pieces(flat_ids)
+
+    out: List[List[str]] = []
+    offset = 0
+    for t in token_lists:
+        out.append(pieces[offset : offset + len(t)])
+        offset += len(t)
+    return out
+
+
+# Number of eager one-token decode steps executed before the step is captured as a CUDA graph.
+# The warm-up keeps lazy initialization work (memory pools, cuBLAS handles, autotuning, ...)
+# out of the capture, which would otherwise either fail or be replayed every step.
+_CUDA_GRAPH_WARMUP_STEPS = 3
+
+# Limits for the K/V prefix cache (see `Llama._load_cached_prefix`). Each cached prefix keeps
+# a K/V snapshot for every layer (~0.5 MB per token for Llama-2-7B in fp16), so the number of
+# entries is kept small, and very short prefixes are not worth the snapshot traffic.
+_PREFIX_CACHE_MAX_ENTRIES = 4
+_PREFIX_CACHE_MIN_TOKENS = 16
+
+# Number of decode steps between checks of the stop condition. Reading `eos_reached` from
+# Python forces a device->host sync that stalls the GPU pipeline, so it is only paid every
+# few steps: the up-to-7 extra forwards after an early stop are cheaper than a sync per token.
+_EOS_CHECK_INTERVAL = 8
+
 
 class Llama:
     """Llama class for text generation using the language model."""
@@ -99,6 +173,8 @@ class Llama:
         max_batch_size: int,
         model_parallel_size: Optional[int] = None,
         seed: int = 1,
+        quantize_kv_cache: bool = False,
+        cache_prompt_prefixes: bool = False,
     ) -> "Llama":
         """Build a Llama instance by initializing and loading a pre-trained model.
 
@@ -110,6 +186,16 @@ class Llama:
             model_parallel_size (Optional[int], optional): Number of model parallel processes.
                 If not provided, it's determined from the environment. Defaults to None.
             seed (int, optional): Random seed for reproducibility. Defaults to 1.
+            quantize_kv_cache (bool, optional): Store the K/V cache as symmetric per-head
+                INT8, halving the cache's resident GPU memory so roughly twice the batch or
+                context fits on the same card, at the cost of a small quantization error and
+                a dequantization pass on every read. Defaults to False.
+            cache_prompt_prefixes (bool, optional): Keep an LRU cache of K/V snapshots for
+                prompt prefixes seen by `generate`, so repeated prompts (typically a fixed
+                system prompt) skip prefill for the shared prefix. Each snapshot holds up
+                to a full prompt of K/V entries per layer (~0.5 MB per token for
+                Llama-2-7B in fp16) in resident GPU memory, so only enable this when
+                prompts actually share prefixes. Defaults to False.
 
         Returns:
             Llama: An instance of the Llama class with the loaded model and tokenizer.
@@ -123,10 +209,31 @@ class Llama:
             and loads the pre-trained model and tokenizer.
 
         """
+        # Get the local rank from the environment and bind the CUDA device *before* NCCL
+        # init: creating the CUDA context first lets the process group build its
+        # communicators against the right device instead of paying a warm-up round trip on
+        # the first collective.
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        torch.cuda.set_device(local_rank)
+
+        # Lower the steady-state overhead of the model-parallel all-reduces issued by the
+        # fairscale layers: surface collective errors instead of hanging, and skip the
+        # recordStream-based memory tracking on communication buffers. Both are only
+        # defaults — an explicit environment wins.
+        os.environ.setdefault("NCCL_ASYNC_ERROR_HANDLING", "1")
+        os.environ.setdefault("TORCH_NCCL_AVOID_RECORD_STREAMS", "1")
+
         # Check if the torch distributed environment is not initialized.
         if not torch.distributed.is_initialized():
             # Initialize the process group for distributed operations using the NCCL backend.
-            torch.distributed.init_process_group("nccl")
+            # `device_id` (PyTorch 2.3+) binds the NCCL communicator to this rank's GPU
+            # eagerly; older versions do not know the kwarg, so fall back to the plain call.
+            try:
+                torch.distributed.init_process_group(
+                    "nccl", device_id=torch.device(f"cuda:{local_rank}")
+                )
+            except TypeError:
+                torch.distributed.init_process_group("nccl")
 
         # Check if model parallel is initialized.
         if not model_parallel_is_initialized():
@@ -136,12 +243,6 @@ class Llama:
             # Initialize model parallel.
             initialize_model_parallel(model_parallel_size)
 
-        # Get the local rank from the environment.
-        local_rank = int(os.environ.get("LOCAL_RANK", 0))
-
-        # Set the device to the local rank.
-        torch.cuda.set_device(local_rank)
-
         # TODO [keli]: Refer to https://github.com/meta-llama/llama/issues/1114
         # `seed` must be the same in all processes.
         torch.manual_seed(seed)
@@ -174,21 +275,50 @@ class Llama:
         # Get the checkpoint path for the current model parallel rank.
         ckpt_path = checkpoints[get_model_parallel_rank()]
 
+        # Hint the kernel that the shard is about to be read front to back, so readahead can
+        # start prefetching it before `torch.load` asks for the bytes. This mostly pays off
+        # on shared filesystems (NFS/Lustre) where many ranks hit one storage endpoint.
+        # The advice values are enums, not flags, so they are issued as separate calls.
+        if hasattr(os, "posix_fadvise"):
+            fd = os.open(ckpt_path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
         # Load the checkpoint into CPU memory.
         # Q: Why load the checkpoint into CPU memory instead of GPU memory?
         # A: Personal guess is to unify the output device, ensuring the output is definitely on the
         # CPU. This improves compatibility and makes it easier for users. Otherwise, you can't
         # predict the output device, it could be the current process's GPU or another process's GPU.
-        checkpoint = torch.load(ckpt_path, map_location="cpu")
+        #
+        # `mmap=True` maps the file instead of reading the whole multi-GB pickle into RAM up
+        # front: tensor data is paged in from the OS page cache as `load_state_dict` consumes
+        # it, which roughly halves the peak host memory and removes the big blocking read.
+        # `weights_only=True` restricts unpickling to tensor data (faster, and no arbitrary
+        # code execution from the checkpoint).
+        checkpoint = torch.load(
+            ckpt_path, map_location="cpu", mmap=True, weights_only=True
+        )
 
         # Load the parameters related to the construction of the model.
-        with open(Path(ckpt_dir) / "params.json", "r") as f:
-            params = json.loads(f.read())
+        # Only rank 0 reads params.json; the parsed dict is broadcast to the other ranks, so
+        # a shared filesystem serves the file once instead of once per process.
+        if torch.distributed.get_rank() == 0:
+            with open(Path(ckpt_dir) / "params.json", "r") as f:
+                params = json.loads(f.read())
+        else:
+            params = None
+        params_list = [params]
+        torch.distributed.broadcast_object_list(params_list, src=0)
+        params = params_list[0]
 
         # Construct the model arguments.
         model_args: ModelArgs = ModelArgs(
             max_seq_len=max_seq_len,
             max_batch_size=max_batch_size,
+            quantize_kv_cache=quantize_kv_cache,
             **params,
         )
 
@@ -198,11 +328,27 @@ class Llama:
         # Set the vocabulary size in the model arguments.
         model_args.vocab_size = tokenizer.n_words
 
-        # Set the default tensor type to half precision (fp16).
-        torch.set_default_tensor_type(torch.cuda.HalfTensor)
+        # Pick the compute dtype explicitly instead of the deprecated global
+        # `torch.set_default_tensor_type(torch.cuda.HalfTensor)`, which silently forced every
+        # default tensor created later in the process onto CUDA fp16. On Ampere and newer,
+        # bf16 matches fp16 matmul throughput with a much wider dynamic range (less softmax
+        # overflow risk); fall back to fp16 on older GPUs.
+        dtype = (
+            torch.bfloat16
+            if torch.cuda.is_bf16_supported()
+            else torch.float16
+        )
 
-        # Construct the model with the model arguments.
-        model = Transformer(model_args)
+        # Construct the model with the model arguments. The default dtype/device are only
+        # overridden for the construction itself and restored right after, so code running
+        # after `build` keeps the normal float32/CPU defaults.
+        default_dtype = torch.get_default_dtype()
+        torch.set_default_dtype(dtype)
+        try:
+            with torch.device("cuda"):
+                model = Transformer(model_args)
+        finally:
+            torch.set_default_dtype(default_dtype)
 
         # Load the model state dictionary from the checkpoint.
         # Q: Why do we use strict=False?
@@ -210,17 +356,190 @@ class Llama:
         # match the checkpoint. Some of the model's parameters may not be present in the
         # checkpoint, but it won't affect the loading process. Partial mismatches can occur when
         # we're in a model parallel environment.
-        model.load_state_dict(checkpoint, strict=False)
+        #
+        # `assign=True` swaps the checkpoint tensors in as the parameters instead of copying
+        # them element-wise into the freshly initialized ones; together with `mmap=True` above
+        # the single copy that remains is the mmap -> GPU transfer done by `.cuda()`.
+        model.load_state_dict(checkpoint, strict=False, assign=True)
+
+        # Move the adopted tensors to the GPU in their stored dtype, then convert on device.
+        # Casting on the host instead would materialize the whole mmap'd checkpoint in RAM
+        # whenever the stored dtype differs from the compute dtype (e.g. an fp16 shard on a
+        # bf16 build), undoing the peak-memory benefit of the mmap load above.
+        model.cuda()
+        model.to(dtype)
 
         # Print the time taken to load the model.
         print(f"Loaded in {time.time() - start_time:.2f} seconds")
 
         # Return the constructed Llama instance.
-        return Llama(model, tokenizer)
+        return Llama(
+            model, tokenizer, cache_prompt_prefixes=cache_prompt_prefixes
+        )
 
-    def __init__(self, model: Transformer, tokenizer: Tokenizer):
+    def __init__(
+        self,
+        model: Transformer,
+        tokenizer: Tokenizer,
+        cache_prompt_prefixes: bool = False,
+    ):
         self.model = model
         self.tokenizer = tokenizer
+        # LRU cache of K/V snapshots for previously seen prompt prefixes, keyed by the prefix
+        # token tuple. Lets repeated prompts (typically a fixed system prompt) skip prefill
+        # for the shared prefix entirely. The snapshots are permanently resident GPU memory
+        # and pure overhead for workloads without repeated prefixes, so the cache is only
+        # used when the instance was built with `cache_prompt_prefixes=True`.
+        self._cache_prompt_prefixes = cache_prompt_prefixes
+        self._prefix_cache: OrderedDict = OrderedDict()
+        # Reusable per-batch-size buffers for `generate` (tokens, pinned host staging,
+        # prompt mask, EOS flags), sized to the model's max_seq_len and sliced per call, so
+        # a serving loop does not reallocate them — the pinned host memory in particular is
+        # a scarce resource.
+        self._gen_bufs: dict = {}
+        # Side CUDA stream for the sampling kernels, created lazily in `generate`.
+        self._sample_stream = None
+        # Captured CUDA graphs for the one-token decode step, keyed by batch size (the only
+        # shape the capture specializes on). Capturing costs a full device sync plus a fresh
+        # graph pool, so the graphs are reused across `generate` calls; a None entry records
+        # that capture failed for that batch size and is not retried.
+        self._decode_graphs: dict = {}
+
+    def _load_cached_prefix(
+        self,
+        prompt_tokens: List[List[int]],
+        bsz: int,
+        min_prompt_len: int,
+    ) -> int:
+        """Load the longest cached K/V prefix shared by every row of the batch.
+
+        Args:
+            prompt_tokens (List[List[int]]): Tokenized prompts of the current batch.
+            bsz (int): Batch size.
+            min_prompt_len (int): Length of the shortest prompt in the batch.
+
+        Returns:
+            int: Number of prefix positions restored into the model's K/V cache; the caller
+                can start prefill at this position. 0 when no cached prefix shares at least
+                `_PREFIX_CACHE_MIN_TOKENS` head tokens with every prompt.
+
+        Note:
+            A snapshot only has to match in its head, not in full: the usable part of an
+            entry is its longest common prefix with the batch, so a snapshot of a whole
+            earlier conversation still serves the fixed system prompt of a new one. At
+            least one prompt token is always left for the first forward call, so the
+            restored prefix is capped at `min_prompt_len - 1`.
+        """
+        best_key = None
+        best_len = 0
+        for key in self._prefix_cache:
+            # K/V entries are valid position by position, so the usable part of a snapshot
+            # is the head it shares with every row of the batch: walk each row up to the
+            # first diverging token and keep the minimum over rows.
+            usable_len = min(len(key), min_prompt_len - 1)
+            for t in prompt_tokens:
+                match_len = 0
+                while (
+                    match_len < usable_len
+                    and t[match_len] == key[match_len]
+                ):
+                    match_len += 1
+                usable_len = match_len
+            # Restoring a handful of positions is not worth the snapshot upload.
+            if usable_len >= _PREFIX_CACHE_MIN_TOKENS and usable_len > best_len:
+                best_key = key
+                best_len = usable_len
+        if best_key is None:
+            return 0
+
+        # Refresh the LRU order and broadcast the snapshot to all batch rows.
+        self._prefix_cache.move_to_end(best_key)
+        self.model.load_prefix_cache(
+            bsz, self._prefix_cache[best_key], prefix_len=best_len
+        )
+        return best_len
+
+    def _store_prefix(
+        self, prompt_tokens: List[List[int]], min_prompt_len: int
+    ) -> None:
+        """Snapshot the K/V entries of the prefix shared by every prompt of the batch.
+
+        Args:
+            prompt_tokens (List[List[int]]): Tokenized prompts of the current batch.
+            min_prompt_len (int): Length of the shortest prompt in the batch; the model's
+                cache must already contain the prefill results up to this position.
+        """
+        # Length of the prefix shared by all rows, capped by the shortest prompt.
+        first = prompt_tokens[0]
+        common_len = min_prompt_len
+        for t in prompt_tokens[1:]:
+            match_len = 0
+            while match_len < common_len and t[match_len] == first[match_len]:
+                match_len += 1
+            common_len = match_len
+
+        if common_len < _PREFIX_CACHE_MIN_TOKENS:
+            return
+        key = tuple(first[:common_len])
+        if key in self._prefix_cache:
+            self._prefix_cache.move_to_end(key)
+            return
+
+        self._prefix_cache[key] = self.model.save_prefix_cache(common_len)
+        # Evict the least recently used snapshot when the cache is full.
+        if len(self._prefix_cache) > _PREFIX_CACHE_MAX_ENTRIES:
+            self._prefix_cache.popitem(last=False)
+
+    def _capture_decode_graph(
+        self, bsz: int
+    ) -> Optional[
+        Tuple[
+            "torch.cuda.CUDAGraph", torch.Tensor, torch.Tensor, torch.Tensor
+        ]
+    ]:
+        """Capture the one-token decode forward pass as a CUDA graph.
+
+        Args:
+            bsz (int): Batch size of the current `generate` call; the captured shapes are
+                specialized to it.
+
+        Returns:
+            Optional[Tuple]: `(graph, static_tok, static_pos, static_logits)` on success, where
+                the caller refreshes `static_tok` / `static_pos` and reads `static_logits`
+                around each `graph.replay()`. None when capture is not possible, in which case
+                the caller stays on the eager per-step path. `generate` caches the result
+                (including a None) per batch size in `self._decode_graphs`, so this runs at
+                most once per batch size for the lifetime of the instance.
+
+        Note:
+            Capture only records the kernel DAG, it does not execute it: the cache writes of
+            the captured step happen on the first `replay()`. The model reads the position
+            from a device tensor (see `Transformer.forward`), so replays with different
+            positions reuse the exact same graph.
+        """
+        if not torch.cuda.is_available():
+            return None
+
+        # NCCL collectives need extra setup to be capturable; keep the graph path for the
+        # single-GPU case where the fairscale layers do not communicate.
+        if get_model_parallel_world_size() > 1:
+            return None
+
+        try:
+            static_tok = torch.zeros(
+                (bsz, 1), dtype=torch.long, device="cuda"
+            )
+            static_pos = torch.zeros((), dtype=torch.long, device="cuda")
+
+            graph = torch.cuda.CUDAGraph()
+            torch.cuda.synchronize()
+            with torch.cuda.graph(graph):
+                static_logits = self.model.forward(static_tok, static_pos)
+            return graph, static_tok, static_pos, static_logits
+        except Exception:
+            # Capture is best-effort: any failure (unsupported op, old driver, ...) simply
+            # leaves generation on the eager per-step path.
+            return None
 
     @torch.inference_mode()
     def generate(
@@ -267,19 +586,47 @@ class Llama:
         total_len = min(params.max_seq_len, max_gen_len + max_prompt_len)
 
         pad_id = self.tokenizer.pad_id
-        tokens = torch.full(
-            (bsz, total_len), pad_id, dtype=torch.long, device="cuda"
-        )
-        for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(
-                t, dtype=torch.long, device="cuda"
+
+        # Reuse the token/mask/flag buffers across `generate` calls instead of reallocating
+        # them every call. The cache is keyed by batch size only, with buffers sized to the
+        # model's max_seq_len and sliced to `total_len` per call: `total_len` varies with
+        # every distinct prompt length, and keying on it would accrete a new set of buffers
+        # (including scarce pinned host memory) per length for the process lifetime.
+        bufs = self._gen_bufs.get(bsz)
+        if bufs is None:
+            bufs = (
+                torch.empty(
+                    (bsz, params.max_seq_len), dtype=torch.long, device="cuda"
+                ),
+                # Pinned (page-locked) staging buffer for the prompt tokens, so the upload
+                # below can be a single asynchronous H2D copy. A slice of a pinned tensor
+                # stays pinned, so the per-call views keep that property.
+                torch.empty(
+                    (bsz, params.max_seq_len), dtype=torch.long, pin_memory=True
+                ),
+                torch.empty(
+                    (bsz, params.max_seq_len), dtype=torch.bool, device="cuda"
+                ),
+                torch.zeros((bsz,), dtype=torch.bool, device="cuda"),
             )
+            self._gen_bufs[bsz] = bufs
+        tokens_full, host_full, mask_full, eos_reached = bufs
+        tokens = tokens_full[:, :total_len]
+        host_tokens = host_full[:, :total_len]
+        input_text_mask = mask_full[:, :total_len]
+        eos_reached.zero_()
+
+        # Stage all prompts in the pinned host buffer and upload them with one async copy,
+        # instead of creating one tiny CUDA tensor (and a synchronous copy) per batch row.
+        host_tokens.fill_(pad_id)
+        for k, t in enumerate(prompt_tokens):
+            host_tokens[k, : len(t)] = torch.as_tensor(t, dtype=torch.long)
+        tokens.copy_(host_tokens, non_blocking=True)
         if logprobs:
             token_logprobs = torch.zeros_like(tokens, dtype=torch.float)
 
         prev_pos = 0
-        eos_reached = torch.tensor([False] * bsz, device="cuda")
-        input_text_mask = tokens != pad_id
+        torch.ne(tokens, pad_id, out=input_text_mask)
         if min_prompt_len == total_len:
             logits = self.model.forward(tokens, prev_pos)
             token_logprobs = -F.cross_entropy(
@@ -289,48 +636,165 @@ class Llama:
                 ignore_index=pad_id,
             )
 
+        # Reuse cached K/V entries when a previously seen prompt prefix (typically a fixed
+        # system prompt) is shared by every row of this batch: prefill then starts after the
+        # prefix and only processes the delta tokens. Opt-in via `cache_prompt_prefixes` on
+        # `build`, and skipped when `logprobs` is requested, because the reused positions
+        # would be missing their log probabilities.
+        use_prefix_cache = (
+            self._cache_prompt_prefixes
+            and min_prompt_len < total_len
+            and not logprobs
+        )
+        if use_prefix_cache:
+            prev_pos = self._load_cached_prefix(
+                prompt_tokens, bsz, min_prompt_len
+            )
+        # When the prefix cache is disabled, pretend the snapshot already exists so the
+        # decode loop never takes one.
+        prefix_saved = not use_prefix_cache
+
+        # CUDA-graph replay state for the one-token decode step. After prefill the forward
+        # launches an identical kernel DAG every token with fixed (bsz, 1) shapes, which makes
+        # it a textbook CUDA-graph target: capture once per batch size, then replay to skip
+        # both the Python dispatch and the per-kernel launch latency. A graph captured by an
+        # earlier `generate` call with the same batch size is replayed right away, without
+        # re-capturing or re-warming.
+        decode_graph = self._decode_graphs.get(bsz)
+        decode_steps = 0
+        steps_since_eos_check = 0
+
+        # Side stream for the sampling kernels. The sampler ops are tiny, so running them on
+        # their own stream lets the Python-side setup of the next forward proceed while they
+        # execute, instead of serializing forward -> sample -> forward on one stream.
+        sample_stream = None
+        if torch.cuda.is_available():
+            if self._sample_stream is None:
+                self._sample_stream = torch.cuda.Stream()
+            sample_stream = self._sample_stream
+
         for cur_pos in range(min_prompt_len, total_len):
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
-            if temperature > 0:
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
+            seqlen = cur_pos - prev_pos
+            if sample_stream is not None:
+                # The previous iteration sampled (and wrote) its token on the side stream;
+                # the forward below consumes it, so order the streams first.
+                torch.cuda.current_stream().wait_stream(sample_stream)
+            if (
+                seqlen == 1
+                and decode_graph is None
+                and bsz not in self._decode_graphs
+                and decode_steps == _CUDA_GRAPH_WARMUP_STEPS
+            ):
+                decode_graph = self._capture_decode_graph(bsz)
+                self._decode_graphs[bsz] = decode_graph
+            if seqlen == 1 and decode_graph is not None:
+                graph, static_tok, static_pos, static_logits = decode_graph
+                # Refresh the static input buffers, replay the recorded kernels, and read the
+                # logits from the static output buffer.
+                static_tok.copy_(tokens[:, prev_pos:cur_pos])
+                static_pos.fill_(prev_pos)
+                graph.replay()
+                logits = static_logits
             else:
-                next_token = torch.argmax(logits[:, -1], dim=-1)
-
-            next_token = next_token.reshape(-1)
-            # only replace token if prompt has already been generated
-            next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
-            )
-            tokens[:, cur_pos] = next_token
-            if logprobs:
-                token_logprobs[:, prev_pos + 1 : cur_pos + 1] = (
-                    -F.cross_entropy(
-                        input=logits.transpose(1, 2),
-                        target=tokens[:, prev_pos + 1 : cur_pos + 1],
-                        reduction="none",
-                        ignore_index=pad_id,
-                    )
+                # Unless per-position logprobs are needed, only the last position's logits
+                # are consumed below — skip the vocabulary projection for the rest of the
+                # prefill chunk.
+                logits = self.model.forward(
+                    tokens[:, prev_pos:cur_pos],
+                    prev_pos,
+                    return_last_only=not logprobs,
                 )
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (
-                next_token == self.tokenizer.eos_id
-            )
+                decode_steps += int(seqlen == 1)
+            if not prefix_saved:
+                # Prefill has run up to `cur_pos`, so the cache now holds the K/V entries of
+                # the shared prompt prefix; snapshot them for reuse by later calls.
+                self._store_prefix(prompt_tokens, min_prompt_len)
+                prefix_saved = True
+            if sample_stream is not None:
+                # The sampler consumes the logits, so the side stream first waits for the
+                # forward. The logits were allocated on the main stream; `record_stream`
+                # tells the caching allocator they are still in use on the side stream, so
+                # their memory is not handed to the next forward while sampling reads it.
+                sample_stream.wait_stream(torch.cuda.current_stream())
+                logits.record_stream(sample_stream)
+            # `torch.cuda.stream(None)` is a no-op, so the CPU-only path falls through.
+            with torch.cuda.stream(sample_stream):
+                if temperature > 0:
+                    next_token = _sample_next_token(
+                        logits[:, -1], temperature, top_p
+                    )
+                else:
+                    next_token = torch.argmax(logits[:, -1], dim=-1)
+
+                next_token = next_token.reshape(-1)
+                # Only replace the token where the position still overlaps a prompt. Past the
+                # longest prompt every position is pure generation, and the prompt mask is
+                # known to be all False there, so the masked select (and the mask reads in
+                # the EOS update below) would be dead work on every remaining step.
+                in_prompt_region = cur_pos < max_prompt_len
+                if in_prompt_region:
+                    next_token = torch.where(
+                        input_text_mask[:, cur_pos],
+                        tokens[:, cur_pos],
+                        next_token,
+                    )
+                tokens[:, cur_pos] = next_token
+                if logprobs:
+                    if seqlen == 1:
+                        # One-token decode step: a log_softmax over the last-position logits
+                        # plus a gather of the realized token gives the same value as the
+                        # cross_entropy below without its transpose/NLL machinery. Note the
+                        # gather happens after the prompt overwrite above, so prompt
+                        # positions score their forced token, exactly like before.
+                        token_logprobs[:, cur_pos] = (
+                            F.log_softmax(logits[:, -1], dim=-1)
+                            .gather(-1, tokens[:, cur_pos : cur_pos + 1])
+                            .squeeze(-1)
+                        )
+                    else:
+                        token_logprobs[:, prev_pos + 1 : cur_pos + 1] = (
+                            -F.cross_entropy(
+                                input=logits.transpose(1, 2),
+                                target=tokens[:, prev_pos + 1 : cur_pos + 1],
+                                reduction="none",
+                                ignore_index=pad_id,
+                            )
+                        )
+                if in_prompt_region:
+                    eos_reached |= (~input_text_mask[:, cur_pos]) & (
+                        next_token == self.tokenizer.eos_id
+                    )
+                else:
+                    eos_reached |= next_token == self.tokenizer.eos_id
             prev_pos = cur_pos
-            if all(eos_reached):
-                break
+            # Check the stop condition only periodically, see `_EOS_CHECK_INTERVAL`. Tokens
+            # generated past an EOS are discarded by the post-loop trimming below, so the
+            # late stop does not change the returned sequences.
+            steps_since_eos_check += 1
+            if steps_since_eos_check >= _EOS_CHECK_INTERVAL:
+                steps_since_eos_check = 0
+                if sample_stream is not None:
+                    # The flags are written on the side stream; order before reading them.
+                    torch.cuda.current_stream().wait_stream(sample_stream)
+                if eos_reached.all().item():
+                    break
+
+        if sample_stream is not None:
+            # The last iteration's token/logprob writes ran on the side stream; join it
+            # before the results are copied back to the host below.
+            torch.cuda.current_stream().wait_stream(sample_stream)
 
-        if logprobs:
-            token_logprobs = token_logprobs.tolist()
         out_tokens, out_logprobs = [], []
-        for i, toks in enumerate(tokens.tolist()):
-            # cut to max gen len
+        for i in range(bsz):
+            # cut to max gen len. The row is sliced on the GPU first so that only the tokens
+            # the caller can actually receive are copied to the host, instead of paying for
+            # the full padded (bsz, total_len) buffer with `tokens.tolist()`.
             start = 0 if echo else len(prompt_tokens[i])
-            toks = toks[start : len(prompt_tokens[i]) + max_gen_len]
+            end = min(len(prompt_tokens[i]) + max_gen_len, total_len)
+            toks = tokens[i, start:end].tolist()
             probs = None
             if logprobs:
-                probs = token_logprobs[i][
-                    start : len(prompt_tokens[i]) + max_gen_len
-                ]
+                probs = token_logprobs[i, start:end].tolist()
             # cut to eos tok if any
             if self.tokenizer.eos_id in toks:
                 eos_idx = toks.index(self.tokenizer.eos_id)
@@ -382,9 +846,14 @@ class Llama:
         # Q: Why don't we add the EOS token?
         # A: Because we need to generate text based on the prompts, so we don't need to add it.
         #######################################################################################
-        prompt_tokens = [
-            self.tokenizer.encode(x, bos=True, eos=False) for x in prompts
-        ]
+        # The encode calls run on the shared thread pool: SentencePiece releases the GIL, so
+        # large prompt batches (e.g. RAG workloads) tokenize in parallel across cores.
+        prompt_tokens = list(
+            _tokenizer_pool().map(
+                lambda x: self.tokenizer.encode(x, bos=True, eos=False),
+                prompts,
+            )
+        )
 
         # Generate text completions based on the prompts.
         generation_tokens, generation_logprobs = self.generate(
@@ -396,21 +865,27 @@ class Llama:
             echo=echo,
         )
 
+        # Decode all sequences with a single batched call instead of one call per sequence.
+        generations = self.tokenizer.decode_batch(generation_tokens)
+
         # If `logprobs` is True, return the text, tokens, and log probabilities.
         if logprobs:
+            token_pieces = _decode_token_pieces(
+                self.tokenizer, generation_tokens
+            )
             return [
                 {
-                    "generation": self.tokenizer.decode(t),
-                    "tokens": [self.tokenizer.decode(x) for x in t],
+                    "generation": generation,
+                    "tokens": pieces,
                     "logprobs": logprobs_i,
                 }
-                for t, logprobs_i in zip(generation_tokens, generation_logprobs)
+                for generation, pieces, logprobs_i in zip(
+                    generations, token_pieces, generation_logprobs
+                )
             ]
 
         # Otherwise, return the text completions.
-        return [
-            {"generation": self.tokenizer.decode(t)} for t in generation_tokens
-        ]
+        return [{"generation": generation} for generation in generations]
 
     def chat_completion(
         self,
@@ -454,20 +929,21 @@ class Llama:
             max_gen_len = self.model.params.max_seq_len - 1
 
         # Since the input dialogs are in the form of messages, we need to encode them into tokens.
-        prompt_tokens = []
+        # Encoding is deferred: this loop only validates the dialogs and builds the formatted
+        # strings (together with their `eos` flag), so that afterwards all segments of all
+        # dialogs can be tokenized in parallel with a single thread-pool map.
+        segment_texts: List[str] = []
+        segment_eos: List[bool] = []
+        # Number of segments contributed by each dialog, used to reassemble the flat results.
+        segments_per_dialog: List[int] = []
         # Check if the dialog contains special tags.
         unsafe_requests = []
 
         for dialog in dialogs:
-            # Check if the dialog contains special tags.
+            # Check if the dialog contains special tags. The generator form lets `any` stop
+            # at the first match instead of materializing the whole list of checks first.
             unsafe_requests.append(
-                any(
-                    [
-                        tag in msg["content"]
-                        for tag in SPECIAL_TAGS
-                        for msg in dialog
-                    ]
-                )
+                any(_TAG_RE.search(msg["content"]) for msg in dialog)
             )
 
             # If the role of the first message is 'system', combine it with the second message.
@@ -495,31 +971,22 @@ class Llama:
             )
 
             # Enumerate the (prompt, answer) pairs in the dialog.
-            # Use (B_INST, E_INST) to wrap the instruction.
-            # `sum` operations is used to concatenate the tokenized dialog. The second parameter
-            # denotes the initial value of the sum operation.
-            # eg. sum([[1, 2], [3, 4]], []) -> [1, 2, 3, 4]
-            dialog_tokens: List[int] = sum(
-                [
-                    self.tokenizer.encode(
-                        f"{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} ",
-                        bos=True,
-                        eos=True,
-                    )
-                    for prompt, answer in zip(
-                        dialog[::2],
-                        dialog[1::2],
-                    )
-                ],
-                [],
-            )
+            # Use (B_INST, E_INST) to wrap the instruction. (Note, `eos=True`)
+            n_segments = 0
+            for prompt, answer in zip(dialog[::2], dialog[1::2]):
+                segment_texts.append(
+                    f"{B_INST} {prompt['content'].strip()} {E_INST} "
+                    f"{answer['content'].strip()} "
+                )
+                segment_eos.append(True)
+                n_segments += 1
 
             # Check if the last message in the dialog is from the user.
             assert (
                 dialog[-1]["role"] == "user"
             ), f"Last message must be from user, got {dialog[-1]['role']}"
 
-            # Encode the last user message and append it to the dialog tokens. (Note, `eos=False`)
+            # Format the last user message as its own segment. (Note, `eos=False`)
             #######################################################################################
             # Q: Why do we need to encode the last user message? Has it not been processed yet?
             # A: Although it seems that zip(dialog[::2], dialog[1::2]) has already enumerated
@@ -528,11 +995,34 @@ class Llama:
             # automatically cut off. eg. zip([1, 4, 5], [2, 3]) -> [(1, 2), (3, 4)].
             # Therefore, we need to encode the last user message separately.
             #######################################################################################
-            dialog_tokens += self.tokenizer.encode(
-                f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST}",
-                bos=True,
-                eos=False,
+            segment_texts.append(
+                f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST}"
             )
+            segment_eos.append(False)
+            segments_per_dialog.append(n_segments + 1)
+
+        # Encode every segment of every dialog with one thread-pool map; SentencePiece releases
+        # the GIL, so the segments tokenize in parallel across cores.
+        encoded_segments = list(
+            _tokenizer_pool().map(
+                lambda seg: self.tokenizer.encode(
+                    seg[0], bos=True, eos=seg[1]
+                ),
+                zip(segment_texts, segment_eos),
+            )
+        )
+
+        # Reassemble the flat segment list into one token list per dialog.
+        # The flattened dialog is built with `extend` instead of `sum([...], [])`: `sum`
+        # concatenates by repeatedly building a new list, which is O(n²) in the total number
+        # of tokens, while `extend` appends in amortized O(n).
+        prompt_tokens = []
+        offset = 0
+        for n_segments in segments_per_dialog:
+            dialog_tokens: List[int] = []
+            for segment in encoded_segments[offset : offset + n_segments]:
+                dialog_tokens.extend(segment)
+            offset += n_segments
             prompt_tokens.append(dialog_tokens)
 
         # Generate assistant responses based on the encoded dialogs.
@@ -544,38 +1034,211 @@ class Llama:
             logprobs=logprobs,
         )
 
+        # Decode all responses with a single batched call instead of one call per sequence.
+        generations = self.tokenizer.decode_batch(generation_tokens)
+
         # Construct the chat predictions based on the generated tokens.
         if logprobs:
+            token_pieces = _decode_token_pieces(
+                self.tokenizer, generation_tokens
+            )
             return [
                 {
                     "generation": {
                         "role": "assistant",
                         "content": (
-                            self.tokenizer.decode(t)
-                            if not unsafe
-                            else UNSAFE_ERROR
+                            generation if not unsafe else UNSAFE_ERROR
                         ),
                     },
-                    "tokens": [self.tokenizer.decode(x) for x in t],
+                    "tokens": pieces,
                     "logprobs": logprobs_i,
                 }
-                for t, logprobs_i, unsafe in zip(
-                    generation_tokens, generation_logprobs, unsafe_requests
+                for generation, pieces, logprobs_i, unsafe in zip(
+                    generations,
+                    token_pieces,
+                    generation_logprobs,
+                    unsafe_requests,
                 )
             ]
         return [
             {
                 "generation": {
                     "role": "assistant",
-                    "content": (
-                        self.tokenizer.decode(t) if not unsafe else UNSAFE_ERROR
-                    ),
+                    "content": generation if not unsafe else UNSAFE_ERROR,
                 }
             }
-            for t, unsafe in zip(generation_tokens, unsafe_requests)
+            for generation, unsafe in zip(generations, unsafe_requests)
         ]
 
 
+def _sample_step(
+    last_logits: torch.Tensor, temperature: float, top_p: float
+) -> torch.Tensor:
+    """Turn the last-position logits into a sampled next token.
+
+    Args:
+        last_logits (torch.Tensor): Logits of the last position. Shape: (batch_size, vocab_size).
+        temperature (float): Temperature value for controlling randomness in sampling.
+            Must be greater than 0.
+        top_p (float): Top-p probability threshold for nucleus sampling.
+
+    Returns:
+        torch.Tensor: Sampled token indices. Shape: (batch_size, 1).
+
+    Note:
+        This is the whole per-step sampling pipeline (temperature scaling, normalization and
+        nucleus sampling) in one function, so that `torch.compile` can fuse the pointwise ops
+        into a single kernel instead of launching softmax/topk/cumsum/... as separate tiny
+        kernels. At batch size 1 the kernel launch overhead dominates the actual compute, so
+        fusing the pipeline is a direct per-token latency win.
+
+        Nucleus selection runs directly on the logits: one `logsumexp` over the vocabulary
+        yields the normalizer, so only the top-k candidates are ever exponentiated and the
+        (batch_size, vocab_size) probability tensor is never materialized. Renormalizing over
+        the nucleus is folded into a single softmax over the masked logits — softmax over the
+        surviving candidates *is* the renormalized distribution, so the zero-then-divide pass
+        of `sample_top_p` disappears.
+    """
+    scaled = last_logits / temperature
+    k = min(SAMPLE_TOP_K, scaled.size(-1))
+
+    if torch.compiler.is_compiling():
+        logits_sort, logits_idx = torch.topk(scaled, k=k, dim=-1)
+    else:
+        logits_sort, logits_idx, probs_sum = _sample_workspace(
+            (scaled.size(0), k), scaled.dtype, scaled.device
+        )
+        torch.topk(scaled, k=k, dim=-1, out=(logits_sort, logits_idx))
+
+    # Probabilities of the candidates under the full distribution; the `logsumexp` is the
+    # only vocabulary-wide reduction left in the pipeline.
+    probs_sort = torch.exp(
+        logits_sort - torch.logsumexp(scaled, dim=-1, keepdim=True)
+    )
+    if torch.compiler.is_compiling():
+        probs_sum = torch.cumsum(probs_sort, dim=-1)
+    else:
+        torch.cumsum(probs_sort, dim=-1, out=probs_sum)
+
+    # Fall back to the reference sampler when the top-k candidates do not cover p (rare for
+    # p <= 0.95, see `sample_top_p`); the check is data dependent, so it is skipped while
+    # tracing under `torch.compile`.
+    if (
+        k < scaled.size(-1)
+        and not torch.compiler.is_compiling()
+        and not torch.all(probs_sum[:, -1] >= top_p)
+    ):
+        return sample_top_p(torch.softmax(scaled, dim=-1), top_p)
+
+    # Create a mask to exclude the tokens whose cumulative probabilities exceed the
+    # threshold p, exactly as in `sample_top_p`.
+    mask = probs_sum - probs_sort > top_p
+
+    # Renormalize by masking the excluded logits to -inf and taking one softmax over the
+    # candidates.
+    probs = torch.softmax(
+        logits_sort.masked_fill(mask, float("-inf")), dim=-1
+    )
+
+    # Sample from the nucleus and map back to vocabulary token indices.
+    next_token = torch.multinomial(probs, num_samples=1)
+    return torch.gather(logits_idx, -1, next_token)
+
+
+# Compiled variant of `_sample_step`. `torch.compile` is lazy: the real compilation happens at
+# the first call, so failures (e.g. no Triton available) surface at runtime and are handled by
+# `_sample_next_token` below. Shapes are fixed across decode steps (bsz, vocab_size), hence
+# `dynamic=False` lets Inductor generate one specialized kernel and replay it every token.
+_sample_step_compiled = (
+    torch.compile(
+        _sample_step, mode="reduce-overhead", fullgraph=True, dynamic=False
+    )
+    if hasattr(torch, "compile")
+    else None
+)
+
+# Set to True after the compiled sampler failed once; from then on we stay on the eager path.
+_sample_step_compile_failed = False
+
+
+def _sample_next_token(
+    last_logits: torch.Tensor, temperature: float, top_p: float
+) -> torch.Tensor:
+    """Run `_sample_step`, preferring the compiled variant with an eager fallback.
+
+    Args:
+        last_logits (torch.Tensor): Logits of the last position. Shape: (batch_size, vocab_size).
+        temperature (float): Temperature value for controlling randomness in sampling.
+        top_p (float): Top-p probability threshold for nucleus sampling.
+
+    Returns:
+        torch.Tensor: Sampled token indices. Shape: (batch_size, 1).
+
+    Note:
+        The compiled graph cannot contain the data-dependent coverage fallback of
+        `_sample_step` (see the `is_compiling` guard there), so under compilation the
+        distribution is silently truncated to the top `SAMPLE_TOP_K` candidates whenever
+        their mass falls short of `top_p`. For `top_p <= 0.95` the top-256 candidates
+        cover the nucleus in practice (see `SAMPLE_TOP_K`); for larger values — including
+        `top_p=1.0`, the standard way to disable nucleus sampling — only the eager path,
+        where the fallback is live, samples the exact distribution, so the compiled
+        variant is bypassed there.
+    """
+    global _sample_step_compile_failed
+    if (
+        top_p <= 0.95
+        and _sample_step_compiled is not None
+        and not _sample_step_compile_failed
+    ):
+        try:
+            return _sample_step_compiled(last_logits, temperature, top_p)
+        except Exception:
+            # Compilation (or the compiled kernel) failed on this setup; remember that and
+            # fall back to the eager implementation for the rest of the process.
+            _sample_step_compile_failed = True
+    return _sample_step(last_logits, temperature, top_p)
+
+
+# Number of candidates considered by the fast path of `sample_top_p`.
+# Q: Why 256?
+# A: With the default `p=0.9` the nucleus of a Llama-2 distribution almost always contains far
+# fewer than 256 tokens, so sorting the 256 most likely candidates is enough to reproduce the
+# result of sorting the whole vocabulary (~32k tokens).
+SAMPLE_TOP_K = 256
+
+# Reusable workspace tensors for the eager path of `sample_top_p`, keyed by shape/dtype/device.
+# At 100+ tokens/sec, allocating fresh sort/cumsum tensors every step costs allocator round
+# trips and fragments the caching allocator; the shapes are identical across steps, so the
+# tensors are allocated once and written in place with the `out=` op variants.
+_SAMPLE_BUFS: dict = {}
+
+
+def _sample_workspace(
+    shape: Tuple[int, ...], dtype: torch.dtype, device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Return the preallocated `(values, indices, cumsum)` workspace for `sample_top_p`.
+
+    Args:
+        shape (Tuple[int, ...]): Shape of the sorted-probabilities tensors.
+        dtype (torch.dtype): Dtype of the probability tensors.
+        device (torch.device): Device the sampler runs on.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Value, index, and cumulative-sum
+            tensors, allocated on first use and reused on every following step.
+    """
+    key = (shape, dtype, str(device))
+    bufs = _SAMPLE_BUFS.get(key)
+    if bufs is None:
+        bufs = (
+            torch.empty(shape, dtype=dtype, device=device),
+            torch.empty(shape, dtype=torch.long, device=device),
+            torch.empty(shape, dtype=dtype, device=device),
+        )
+        _SAMPLE_BUFS[key] = bufs
+    return bufs
+
+
 def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
     """Perform top-p (nucleus) sampling on a probability distribution.
 
@@ -600,14 +1263,46 @@ def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
 
         Refer: https://community.openai.com/t/temperature-top-p-and-top-k-for-chatbot-responses/295542
     """
-    # Sort in descending order because nucleus sampling selects the token set from highest
-    # to lowest probability.
-    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    # Take the `SAMPLE_TOP_K` most likely candidates instead of sorting the whole vocabulary.
+    # Q: Why not sort the whole vocabulary directly?
+    # A: The nucleus is usually tiny (often fewer than 100 tokens), so a full O(V log V) sort
+    # wastes almost all of its work. `torch.topk` is a single O(V) reduction and already returns
+    # its candidates sorted in descending order, which is exactly what the masking below needs.
+    k = min(SAMPLE_TOP_K, probs.size(-1))
+    if torch.compiler.is_compiling():
+        # Inductor plans its own fused buffers, so the compiled path just uses the
+        # functional ops.
+        probs_sort, probs_idx = torch.topk(probs, k=k, dim=-1)
+    else:
+        # Eager path: write into the preallocated workspace instead of allocating fresh
+        # tensors on every decode step.
+        probs_sort, probs_idx, probs_sum = _sample_workspace(
+            (probs.size(0), k), probs.dtype, probs.device
+        )
+        torch.topk(probs, k=k, dim=-1, out=(probs_sort, probs_idx))
+
+    # Fall back to the full sort when the top-k candidates do not cover the threshold p.
+    # This is rare for the default `p=0.9`, but without it the sampled set would be silently
+    # truncated for very flat distributions (e.g. high temperature with p close to 1).
+    # The check is data dependent, so it is skipped while tracing under `torch.compile`
+    # (`fullgraph=True` cannot represent the branch); the compiled sampler then samples from
+    # the top `SAMPLE_TOP_K` candidates, which is indistinguishable for p <= 0.95.
+    if (
+        k < probs.size(-1)
+        and not torch.compiler.is_compiling()
+        and not torch.all(probs_sort.sum(dim=-1) >= p)
+    ):
+        # Sort in descending order because nucleus sampling selects the token set from highest
+        # to lowest probability.
+        probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
 
     # Calculate the cumulative sum of probabilities.
     # This is to quickly perform subtraction later to determine if a token is within the
     # top-p (nucleus) set.
-    probs_sum = torch.cumsum(probs_sort, dim=-1)
+    if torch.compiler.is_compiling() or probs_sort.size(-1) != k:
+        probs_sum = torch.cumsum(probs_sort, dim=-1)
+    else:
+        torch.cumsum(probs_sort, dim=-1, out=probs_sum)
 
     # Create a mask to exclude the tokens that their cumulative probabilities exceed the
     # threshold p.
@@ -4,7 +4,7 @@
 
 import math
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 import fairscale.nn.model_parallel.initialize as fs_init
 import torch
@@ -35,6 +35,14 @@ class ModelArgs:
     max_batch_size: int = 32
     max_seq_len: int = 2048
 
+    # Store the K/V cache as symmetric per-head INT8 instead of the compute dtype, halving
+    # the cache's resident GPU memory — roughly twice the batch (or context) fits on the
+    # same card. Note this is a *capacity* optimization: the pure-PyTorch attention path
+    # dequantizes the read slice into compute-dtype tensors before the matmuls, so per-step
+    # memory traffic is not reduced (a fused dequantizing attention kernel would be needed
+    # for that).
+    quantize_kv_cache: bool = False
+
 
 class RMSNorm(torch.nn.Module):
     """RMSNorm, refer to docs/EN/RMSNorm."""
@@ -171,6 +179,27 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+def quantize_int8(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Quantize a K/V tensor to symmetric per-head INT8.
+
+    Args:
+        x (torch.Tensor): Tensor of shape (bsz, seqlen, n_heads, head_dim).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The INT8 tensor with the same shape as `x`, and
+            the float32 scales of shape (bsz, seqlen, n_heads, 1) such that
+            `int8 * scale ≈ x`.
+    """
+    scale = x.abs().amax(dim=-1, keepdim=True).float() / 127.0
+    # Guard against all-zero heads: a zero scale would divide by zero below, and any value
+    # quantized against it dequantizes to zero anyway.
+    scale = scale.clamp(min=1e-8)
+    quantized = (
+        torch.round(x.float() / scale).clamp_(-127, 127).to(torch.int8)
+    )
+    return quantized, scale
+
+
 class Attention(nn.Module):
     """Multi-Head Self-Attention (多头自注意力机制)."""
 
@@ -192,6 +221,8 @@ class Attention(nn.Module):
             wo (RowParallelLinear): Linear transformation for output.
             cache_k (torch.Tensor): Cached keys for attention.
             cache_v (torch.Tensor): Cached values for attention.
+            quantize_kv_cache (bool): Whether the cache stores INT8 entries with per-head
+                scales (`cache_k_scale` / `cache_v_scale`) instead of the compute dtype.
 
         """
         super().__init__()
@@ -233,27 +264,34 @@ class Attention(nn.Module):
             init_method=lambda x: x,
         )
 
-        self.cache_k = torch.zeros(
-            (
-                args.max_batch_size,
-                args.max_seq_len,
-                self.n_local_kv_heads,
-                self.head_dim,
-            )
-        ).cuda()
-        self.cache_v = torch.zeros(
-            (
-                args.max_batch_size,
-                args.max_seq_len,
-                self.n_local_kv_heads,
-                self.head_dim,
-            )
-        ).cuda()
+        self.quantize_kv_cache = args.quantize_kv_cache
+
+        cache_shape = (
+            args.max_batch_size,
+            args.max_seq_len,
+            self.n_local_kv_heads,
+            self.head_dim,
+        )
+        if self.quantize_kv_cache:
+            # INT8 cache plus one float32 scale per (batch, position, head); the scales add
+            # only head_dim'th of the cache size in extra bytes.
+            scale_shape = cache_shape[:-1] + (1,)
+            self.cache_k = torch.zeros(cache_shape, dtype=torch.int8).cuda()
+            self.cache_v = torch.zeros(cache_shape, dtype=torch.int8).cuda()
+            self.cache_k_scale = torch.zeros(
+                scale_shape, dtype=torch.float32
+            ).cuda()
+            self.cache_v_scale = torch.zeros(
+                scale_shape, dtype=torch.float32
+            ).cuda()
+        else:
+            self.cache_k = torch.zeros(cache_shape).cuda()
+            self.cache_v = torch.zeros(cache_shape).cuda()
 
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
+        start_pos: Union[int, torch.Tensor],
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
     ):
@@ -261,7 +299,9 @@ class Attention(nn.Module):
 
         Args:
             x (torch.Tensor): Input tensor.
-            start_pos (int): Starting position for caching.
+            start_pos (Union[int, torch.Tensor]): Starting position for caching. A 0-dim CUDA
+                tensor selects the CUDA-graph friendly one-token decode path, see
+                `Transformer.forward`.
             freqs_cis (torch.Tensor): Precomputed frequency tensor.
             mask (torch.Tensor, optional): Attention mask tensor.
 
@@ -278,14 +318,61 @@ class Attention(nn.Module):
 
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        self.cache_k = self.cache_k.to(xq)
-        self.cache_v = self.cache_v.to(xq)
-
-        self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
-        self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
-
-        keys = self.cache_k[:bsz, : start_pos + seqlen]
-        values = self.cache_v[:bsz, : start_pos + seqlen]
+        if self.quantize_kv_cache:
+            # Quantize the new entries on write so the resident cache stays INT8-sized; the
+            # read slice is expanded back to the compute dtype below.
+            xk_store, xk_scale = quantize_int8(xk)
+            xv_store, xv_scale = quantize_int8(xv)
+        else:
+            self.cache_k = self.cache_k.to(xq)
+            self.cache_v = self.cache_v.to(xq)
+            xk_store, xv_store = xk, xv
+
+        if torch.is_tensor(start_pos):
+            # One-token decode with a device-resident position (CUDA-graph capture/replay).
+            # Every shape must be independent of the position here: scatter the new K/V entry
+            # with `index_copy_` and attend over the *full* cache; the mask built in
+            # `Transformer.forward` hides the slots that have not been written yet.
+            pos = start_pos.reshape(1)
+            self.cache_k[:bsz].index_copy_(1, pos, xk_store)
+            self.cache_v[:bsz].index_copy_(1, pos, xv_store)
+            if self.quantize_kv_cache:
+                self.cache_k_scale[:bsz].index_copy_(1, pos, xk_scale)
+                self.cache_v_scale[:bsz].index_copy_(1, pos, xv_scale)
+
+            keys = self.cache_k[:bsz]
+            values = self.cache_v[:bsz]
+            if self.quantize_kv_cache:
+                keys_scale = self.cache_k_scale[:bsz]
+                values_scale = self.cache_v_scale[:bsz]
+        else:
+            self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk_store
+            self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv_store
+            if self.quantize_kv_cache:
+                self.cache_k_scale[:bsz, start_pos : start_pos + seqlen] = (
+                    xk_scale
+                )
+                self.cache_v_scale[:bsz, start_pos : start_pos + seqlen] = (
+                    xv_scale
+                )
+
+            keys = self.cache_k[:bsz, : start_pos + seqlen]
+            values = self.cache_v[:bsz, : start_pos + seqlen]
+            if self.quantize_kv_cache:
+                keys_scale = self.cache_k_scale[
+                    :bsz, : start_pos + seqlen
+                ]
+                values_scale = self.cache_v_scale[
+                    :bsz, : start_pos + seqlen
+                ]
+
+        if self.quantize_kv_cache:
+            # Dequantize directly in the compute dtype — no float32 round trip, so the only
+            # intermediate is one compute-dtype copy of the read slice. That copy is the
+            # price of keeping the resident cache at INT8 size; it means this mode trades
+            # some decode speed for capacity rather than reducing memory traffic.
+            keys = keys.to(xq.dtype).mul_(keys_scale.to(xq.dtype))
+            values = values.to(xq.dtype).mul_(values_scale.to(xq.dtype))
 
         # repeat k/v heads if n_kv_heads < n_heads
         keys = repeat_kv(
@@ -416,7 +503,7 @@ class TransformerBlock(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
+        start_pos: Union[int, torch.Tensor],
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
     ):
@@ -424,7 +511,7 @@ class TransformerBlock(nn.Module):
 
         Args:
             x (torch.Tensor): Input tensor.
-            start_pos (int): Starting position for attention caching.
+            start_pos (Union[int, torch.Tensor]): Starting position for attention caching.
             freqs_cis (torch.Tensor): Precomputed cosine and sine frequencies.
             mask (torch.Tensor, optional): Masking tensor for attention. Defaults to None.
 
@@ -486,40 +573,154 @@ class Transformer(nn.Module):
         )
 
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int):
+    def save_prefix_cache(
+        self, prefix_len: int
+    ) -> List[Tuple[torch.Tensor, ...]]:
+        """Snapshot the per-layer K/V cache entries of a shared prompt prefix.
+
+        Args:
+            prefix_len (int): Number of leading cache positions to snapshot.
+
+        Returns:
+            List[Tuple[torch.Tensor, ...]]: One `(keys, values)` pair per layer, each of
+                shape (prefix_len, n_local_kv_heads, head_dim). With a quantized cache the
+                tuple additionally carries the `(keys_scale, values_scale)` tensors.
+
+        Note:
+            Only row 0 of the batch is saved: K/V entries depend only on the token prefix
+            itself, so a prefix shared by every row produces identical entries in every row.
+        """
+        if self.params.quantize_kv_cache:
+            return [
+                (
+                    layer.attention.cache_k[0, :prefix_len].clone(),
+                    layer.attention.cache_v[0, :prefix_len].clone(),
+                    layer.attention.cache_k_scale[0, :prefix_len].clone(),
+                    layer.attention.cache_v_scale[0, :prefix_len].clone(),
+                )
+                for layer in self.layers
+            ]
+        return [
+            (
+                layer.attention.cache_k[0, :prefix_len].clone(),
+                layer.attention.cache_v[0, :prefix_len].clone(),
+            )
+            for layer in self.layers
+        ]
+
+    @torch.inference_mode()
+    def load_prefix_cache(
+        self,
+        bsz: int,
+        cached: List[Tuple[torch.Tensor, ...]],
+        prefix_len: Optional[int] = None,
+    ) -> None:
+        """Copy a saved prefix K/V snapshot back into the cache of every layer.
+
+        Args:
+            bsz (int): Number of batch rows to fill; the snapshot is broadcast to all of them.
+            cached (List[Tuple[torch.Tensor, ...]]): Snapshot produced by
+                `save_prefix_cache`.
+            prefix_len (Optional[int], optional): Number of leading positions to restore.
+                Defaults to the full snapshot length, a smaller value restores only the head
+                of the snapshot.
+
+        Note:
+            After loading, the first `forward` call of a generation can start at
+            `start_pos=prefix_len` and only process the tokens after the prefix.
+        """
+        if prefix_len is None:
+            prefix_len = cached[0][0].size(0)
+        for layer, entry in zip(self.layers, cached):
+            keys, values = entry[0], entry[1]
+            layer.attention.cache_k[:bsz, :prefix_len] = keys[:prefix_len]
+            layer.attention.cache_v[:bsz, :prefix_len] = values[:prefix_len]
+            if self.params.quantize_kv_cache:
+                keys_scale, values_scale = entry[2], entry[3]
+                layer.attention.cache_k_scale[:bsz, :prefix_len] = (
+                    keys_scale[:prefix_len]
+                )
+                layer.attention.cache_v_scale[:bsz, :prefix_len] = (
+                    values_scale[:prefix_len]
+                )
+
+    @torch.inference_mode()
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        start_pos: Union[int, torch.Tensor],
+        return_last_only: bool = False,
+    ):
         """Perform a forward pass through the Transformer model.
 
         Args:
             tokens (torch.Tensor): Input token indices.
-            start_pos (int): Starting position for attention caching.
+            start_pos (Union[int, torch.Tensor]): Starting position for attention caching.
+                A 0-dim CUDA tensor is accepted for one-token decode so the step can be
+                captured and replayed as a CUDA graph: the position is then read on device
+                instead of being baked into kernel launch parameters, which keeps the op
+                DAG (and all shapes) identical across decode steps.
+            return_last_only (bool, optional): Only compute logits for the last position.
+                The output projection is a (dim, vocab_size) GEMM per position, so when the
+                caller samples a single continuation, skipping it for every prompt position
+                saves seqlen-1 vocabulary-wide matmuls. Defaults to False.
 
         Returns:
-            torch.Tensor: Output logits after applying the Transformer model.
+            torch.Tensor: Output logits after applying the Transformer model. Shape
+                (bsz, seqlen, vocab_size), or (bsz, 1, vocab_size) with `return_last_only`.
 
         """
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
         self.freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
 
-        mask = None
-        if seqlen > 1:
-            mask = torch.full(
-                (seqlen, seqlen), float("-inf"), device=tokens.device
+        if torch.is_tensor(start_pos):
+            # CUDA-graph friendly one-token decode. All shapes below must be independent of
+            # the (device-resident) position: select the rotary frequencies with an on-device
+            # gather and attend over the full cache, masking the slots past `start_pos` that
+            # have not been written yet.
+            assert (
+                seqlen == 1
+            ), "tensor start_pos is only supported for one-token decode"
+            freqs_cis = self.freqs_cis.index_select(0, start_pos.reshape(1))
+
+            positions = torch.arange(
+                self.params.max_seq_len, device=tokens.device
             )
-
-            mask = torch.triu(mask, diagonal=1)
-
-            # When performing key-value caching, we compute the attention scores
-            # only for the new sequence. Thus, the matrix of scores is of size
-            # (seqlen, cache_len + seqlen), and the only masked entries are (i, j) for
-            # j > cache_len + i, since row i corresponds to token cache_len + i.
-            mask = torch.hstack(
-                [torch.zeros((seqlen, start_pos), device=tokens.device), mask]
-            ).type_as(h)
+            mask = torch.zeros(
+                self.params.max_seq_len, device=tokens.device
+            ).masked_fill(positions > start_pos, float("-inf"))
+            mask = mask.type_as(h)
+        else:
+            freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
+
+            mask = None
+            if seqlen > 1:
+                mask = torch.full(
+                    (seqlen, seqlen), float("-inf"), device=tokens.device
+                )
+
+                mask = torch.triu(mask, diagonal=1)
+
+                # When performing key-value caching, we compute the attention scores
+                # only for the new sequence. Thus, the matrix of scores is of size
+                # (seqlen, cache_len + seqlen), and the only masked entries are (i, j) for
+                # j > cache_len + i, since row i corresponds to token cache_len + i.
+                mask = torch.hstack(
+                    [
+                        torch.zeros(
+                            (seqlen, start_pos), device=tokens.device
+                        ),
+                        mask,
+                    ]
+                ).type_as(h)
 
         for layer in self.layers:
             h = layer(h, start_pos, freqs_cis, mask)
+        if return_last_only:
+            # The norm is applied per position, so slicing before it (and before the output
+            # projection) is safe and shrinks both to a single position.
+            h = h[:, -1:]
         h = self.norm(h)
         output = self.output(h).float()
         return output
@@ -66,3 +66,37 @@ class Tokenizer:
             str: The decoded string.
         """
         return self.sp_model.decode(t)
+
+    def decode_batch(self, ts: List[List[int]]) -> List[str]:
+        """
+        Decodes a batch of token ID lists into strings with a single call.
+
+        Args:
+            ts (List[List[int]]): The lists of token IDs to be decoded.
+
+        Returns:
+            List[str]: The decoded strings, one per input list.
+
+        Note:
+            SentencePiece accepts a list of sequences directly, so this performs a single
+            Python<->C++ transition for the whole batch instead of one per sequence.
+        """
+        return self.sp_model.decode(ts)
+
+    def pieces(self, t: List[int]) -> List[str]:
+        """
+        Decodes each token ID into its surface string with one batched call.
+
+        Args:
+            t (List[int]): The list of token IDs.
+
+        Returns:
+            List[str]: One decoded string per token ID.
+
+        Note:
+            Decoding token by token would rebuild a detokenizer per call and cross the
+            Python<->C++ boundary once per token. `id_to_piece` maps the whole list in a
+            single call; the SentencePiece whitespace rule (the `▁` piece prefix marks a
+            space) is then applied with a plain string replace on the Python side.
+        """
+        return [p.replace("▁", " ") for p in self.sp_model.id_to_piece(t)]